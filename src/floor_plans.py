@@ -0,0 +1,188 @@
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+from apify import Actor
+
+from .models import ZillowSearchParameters
+
+class FloorPlanTable:
+    """Every floor plan of a set of buildings, stored as one array per field.
+
+    Row i describes one floor plan of the building at index building[i] in the
+    list the table was built from. Missing values are stored as NaN.
+    """
+
+    def __init__(self, building: np.ndarray, beds: np.ndarray, baths: np.ndarray, price: np.ndarray):
+        self.building = building
+        self.beds = beds
+        self.baths = baths
+        self.price = price
+
+    def __len__(self) -> int:
+        return len(self.building)
+
+    @classmethod
+    def from_items(cls, items: List[Dict[str, Any]]) -> "FloorPlanTable":
+        """Build the table from raw Zillow detail scraper items.
+
+        Args:
+            items: Raw items from the Zillow detail scraper dataset
+
+        Returns:
+            Table with one row per floor plan, linked to the index of its item
+        """
+        building, beds, baths, price = [], [], [], []
+        for i, item in enumerate(items):
+            for plan in item.get("floorPlans") or []:
+                building.append(i)
+                beds.append(plan.get("beds"))
+                baths.append(plan.get("baths"))
+                # Use minPrice or maxPrice, whichever is available
+                price.append(plan.get("minPrice") or plan.get("maxPrice"))
+
+        # None becomes NaN, so comparisons against missing values are always False
+        return cls(
+            building=np.asarray(building, dtype=np.int32),
+            beds=np.asarray(beds, dtype=np.float64),
+            baths=np.asarray(baths, dtype=np.float64),
+            price=np.asarray(price, dtype=np.float64),
+        )
+
+    def unknown(self, search_params: ZillowSearchParameters) -> np.ndarray:
+        """Get a boolean mask of the floor plans missing a value the search parameters filter on."""
+        mask = np.zeros(len(self), dtype=bool)
+        if search_params.beds_min is not None:
+            mask |= np.isnan(self.beds)
+        if search_params.baths_min is not None:
+            mask |= np.isnan(self.baths)
+        if search_params.price_min is not None or search_params.price_max is not None:
+            mask |= np.isnan(self.price)
+        return mask
+
+    def matches(self, search_params: ZillowSearchParameters) -> np.ndarray:
+        """Get a boolean mask of the floor plans meeting the search parameters.
+
+        Floor plans missing a filtered value never match, see unknown().
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if search_params.beds_min is not None:
+            mask &= self.beds >= search_params.beds_min
+        if search_params.baths_min is not None:
+            mask &= self.baths >= search_params.baths_min
+        if search_params.price_min is not None:
+            mask &= self.price >= search_params.price_min
+        if search_params.price_max is not None:
+            mask &= self.price <= search_params.price_max
+        return mask
+
+    def averages(self, building_count: int) -> Dict[str, np.ndarray]:
+        """Get the average beds, baths and price per building over its floor plans with beds and baths.
+
+        Missing prices count as 0, and buildings without such floor plans get a count of 0.
+        """
+        valid = ~np.isnan(self.beds) & ~np.isnan(self.baths)
+        building = self.building[valid]
+        counts = np.bincount(building, minlength=building_count)
+        # Avoid dividing by zero, those buildings are recognized by their count
+        divisor = np.maximum(counts, 1)
+        return {
+            "count": counts,
+            "beds": np.bincount(building, weights=self.beds[valid], minlength=building_count) / divisor,
+            "baths": np.bincount(building, weights=self.baths[valid], minlength=building_count) / divisor,
+            "price": np.bincount(building, weights=np.nan_to_num(self.price[valid]), minlength=building_count) / divisor,
+        }
+
+    def cheapest(self, mask: np.ndarray, building_count: int) -> np.ndarray:
+        """Get the row of the cheapest floor plan in the mask for each building, or -1 if it has none."""
+        rows = np.flatnonzero(mask)
+        # Sort by building, then by price with missing prices last
+        order = rows[np.lexsort((np.nan_to_num(self.price[rows], nan=np.inf), self.building[rows]))]
+        buildings, first = np.unique(self.building[order], return_index=True)
+        cheapest = np.full(building_count, -1, dtype=np.int64)
+        cheapest[buildings] = order[first]
+        return cheapest
+
+def _to_number(value: float) -> Optional[float]:
+    """Convert an array value back to a JSON friendly number."""
+    if np.isnan(value):
+        return None
+    return int(value) if float(value).is_integer() else float(value)
+
+def apply_unit_level_matching(
+    items: List[Dict[str, Any]],
+    filtered_items: List[Dict[str, Any]],
+    search_params: ZillowSearchParameters
+) -> List[Dict[str, Any]]:
+    """Describe apartment buildings by their floor plans that meet the search parameters.
+
+    Instead of an average over all floor plans, buildings get the bedrooms,
+    bathrooms and price of their cheapest matching floor plan and the matching
+    floor plans themselves, with unitsVerified set to True. Buildings without
+    a matching floor plan but with floor plans missing a filtered value cannot
+    be checked; they get the average over their floor plans, as without
+    unit-level matching, with unitsVerified set to False. Buildings whose
+    floor plans all have the filtered values and none match are dropped.
+    Properties without floor plans are kept unchanged.
+
+    Args:
+        items: Raw items from the Zillow detail scraper dataset
+        filtered_items: The same items processed by filter_zillow_detail without averaging
+        search_params: Search parameters to match the floor plans against
+
+    Returns:
+        The filtered items with unit-level details
+    """
+    table = FloorPlanTable.from_items(items)
+    if len(table) == 0:
+        return filtered_items
+
+    mask = table.matches(search_params)
+    plan_counts = np.bincount(table.building, minlength=len(items))
+    match_counts = np.bincount(table.building[mask], minlength=len(items))
+    unknown_counts = np.bincount(table.building[table.unknown(search_params)], minlength=len(items))
+    cheapest = table.cheapest(mask, len(items))
+    averages = table.averages(len(items))
+
+    # Group the matching rows per building with a single stable sort
+    matching_rows = np.flatnonzero(mask)
+    matching_rows = matching_rows[np.argsort(table.building[matching_rows], kind="stable")]
+    row_groups = np.split(matching_rows, np.cumsum(match_counts)[:-1])
+
+    results = []
+    dropped = 0
+    unverified = 0
+    for i, filtered_item in enumerate(filtered_items):
+        if plan_counts[i] == 0:
+            results.append(filtered_item)
+            continue
+        if match_counts[i] == 0:
+            if unknown_counts[i] > 0:
+                if averages["count"][i] > 0:
+                    filtered_item["bedrooms"] = int(averages["beds"][i])
+                    filtered_item["bathrooms"] = int(averages["baths"][i])
+                    filtered_item["price"] = int(averages["price"][i])
+                filtered_item["unitsVerified"] = False
+                results.append(filtered_item)
+                unverified += 1
+            else:
+                dropped += 1
+            continue
+
+        row = cheapest[i]
+        group = row_groups[i]
+        filtered_item["bedrooms"] = _to_number(table.beds[row])
+        filtered_item["bathrooms"] = _to_number(table.baths[row])
+        filtered_item["price"] = _to_number(table.price[row])
+        filtered_item["unitsVerified"] = True
+        filtered_item["matchingFloorPlans"] = [
+            {"beds": _to_number(beds), "baths": _to_number(baths), "price": _to_number(price)}
+            for beds, baths, price in zip(table.beds[group], table.baths[group], table.price[group])
+        ]
+        results.append(filtered_item)
+
+    if dropped or unverified:
+        Actor.log.info(
+            f"Unit-level matching dropped {dropped} buildings without matching floor plans "
+            f"and kept {unverified} buildings whose floor plans lack the data to check"
+        )
+    return results
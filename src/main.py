@@ -2,6 +2,7 @@ from apify import Actor
 from apify_client import ApifyClient
 import os
 from dotenv import load_dotenv
+from pydantic import ValidationError
 from pydantic_ai import Agent
 from pydantic_ai.models.gemini import GeminiModel
 from pydantic_ai.models.openai import OpenAIModel
@@ -10,8 +11,10 @@ import math
 import json
 
 from .prompts import ZILLOW_SEARCH_EXPERT_SYSTEM_PROMPT, REAL_ESTATE_AGENT_SYSTEM_PROMPT
-from .models import ZillowSearchParameters, Deps, RealEstateAgentResult
-from .tools import construct_zillow_url, search_zillow, get_zillow_details, generate_markdown_report
+from .models import ZillowSearchParameters, Deps, Property, RealEstateAgentResult, StreamedRealEstateAgentResult
+from .market_stats import load_market_stats, save_market_stats, format_market_stats
+from .storage import CONTENT_TYPE, encode_run_output, recommendation_refs
+from .tools import construct_zillow_url, search_zillow, get_zillow_details, stream_zillow_details, generate_markdown_report
 
 load_dotenv()
 
@@ -37,6 +40,49 @@ real_estate_agent = Agent(
     model_settings=ModelSettings(temperature=0),
 )
 
+# Same agent with a partially validatable result type, used when streaming results
+streaming_real_estate_agent = Agent(
+    gemini_flash_2_model,
+    system_prompt = REAL_ESTATE_AGENT_SYSTEM_PROMPT,
+    result_type=StreamedRealEstateAgentResult,
+    deps_type=Deps,
+    model_settings=ModelSettings(temperature=0),
+)
+
+def merge_recommendation(ai_prop, url_to_details: dict) -> dict:
+    """Merge an AI recommendation with the full Zillow details of the property it refers to."""
+    # Get the URL from the AI's evaluation
+    ai_prop_data = ai_prop.model_dump()
+    url = ai_prop_data.get('url', '')
+    
+    # Find matching property in zillow_details by URL
+    full_property_details = url_to_details.get(url)
+    
+    if full_property_details:
+        # Keep all the original Zillow details
+        enhanced_property = dict(full_property_details)
+        # Add the AI's reason
+        enhanced_property['match_reason'] = ai_prop_data.get('match_reason', '')
+        return enhanced_property
+    
+    # If no match found, use the AI's data as fallback
+    return ai_prop_data
+
+def recommendation_item(recommendation: dict, listings: list, compact_storage: bool) -> dict:
+    """Build the streamed dataset item for a single merged recommendation."""
+    if compact_storage:
+        # Refer to the listing by id instead of copying its details
+        recommendation = recommendation_refs(listings, [recommendation])[0]
+    return {'type': 'recommendation', **recommendation}
+
+def listing_item(listing_id: int, listing: dict) -> dict:
+    """Build the streamed dataset item for a single listing.
+
+    Listings keep their full details even with compact storage, so they are
+    usable as soon as they are pushed rather than once run_output is written.
+    """
+    return {'type': 'listing', 'listing_id': listing_id, **listing}
+
 async def main() -> None:
     async with Actor:
         actor_input = await Actor.get_input() 
@@ -44,6 +90,10 @@ async def main() -> None:
         await Actor.charge('init', 1)
         
         search = actor_input.get("search")
+        stream_results = actor_input.get("streamResults", False)
+        compact_storage = actor_input.get("compactStorage", False)
+        unit_level_matching = actor_input.get("unitLevelMatching", False)
+        use_market_stats = actor_input.get("marketStats", True)
         
         zillow_parameters = await zillow_search_expert.run(
             f"get the zillow parameters for this request: {search}"
@@ -54,84 +104,166 @@ async def main() -> None:
         await Actor.charge(event_name='1k-llm-tokens', count=math.ceil(usage.total_tokens / 1000))
         zillow_url = await construct_zillow_url(zillow_parameters.data)
         
+        # Create search_parameters object
+        search_parameters = zillow_parameters.data.model_dump()
+        search_parameters['zillow_url'] = zillow_url
+        
+        # In streaming mode every stage is pushed as its own dataset item, tagged by type
+        if stream_results:
+            await Actor.push_data({'type': 'search_parameters', 'search_parameters': search_parameters})
+        
         # Perform the search
         zillow_results = await search_zillow(search_url=zillow_url)
         
+        # Load the market statistics shared across runs
+        market_stats_index = None
+        previous_market_stats = None
+        if use_market_stats:
+            try:
+                market_stats_index = await load_market_stats()
+                # Summaries only describe earlier searches, not the listings this run adds
+                previous_market_stats = market_stats_index.snapshot()
+            except Exception as e:
+                # Skip market statistics for this run rather than overwrite the stored index
+                Actor.log.error(f"Error loading market statistics: {str(e)}")
+        
         # Get the details of the properties
-        zillow_details = await get_zillow_details(property_urls=zillow_results, for_rent=zillow_parameters.data.for_rent)
+        unit_search_params = zillow_parameters.data if unit_level_matching else None
+        if stream_results:
+            zillow_details = []
+            async for batch in stream_zillow_details(property_urls=zillow_results, for_rent=zillow_parameters.data.for_rent, unit_search_params=unit_search_params, market_stats_index=market_stats_index):
+                first_id = len(zillow_details)
+                zillow_details.extend(batch)
+                await Actor.push_data([listing_item(first_id + i, listing) for i, listing in enumerate(batch)])
+        else:
+            zillow_details = await get_zillow_details(property_urls=zillow_results, for_rent=zillow_parameters.data.for_rent, unit_search_params=unit_search_params, market_stats_index=market_stats_index)
         
-        # Create search_parameters object
-        search_parameters = zillow_parameters.data.model_dump()
-        search_parameters['zillow_url'] = zillow_url
+        market_stats = []
+        if market_stats_index is not None:
+            try:
+                await save_market_stats(market_stats_index)
+            except Exception as e:
+                Actor.log.error(f"Error saving market statistics: {str(e)}")
+            market_stats = previous_market_stats.summarize(zillow_details, for_rent=zillow_parameters.data.for_rent)
         
         # Initialize output_data dictionary
         output_data = {
-            'search_parameters': search_parameters
+            'search_parameters': search_parameters,
+            'market_stats': market_stats
         }
         
-        # Save Zillow details to KV store
+        # Save Zillow details to KV store, in compact mode they are stored with the run output below
         default_kv_store = await Actor.open_key_value_store()
-        await default_kv_store.set_value('zillow_details', zillow_details)
+        if not compact_storage:
+            await default_kv_store.set_value('zillow_details', zillow_details)
+        
+        # Recommendations already pushed in streaming mode, kept if the analysis fails midway
+        streamed_recommendations = []
         
         try:
             # Update prompt to include requirement for URL
             modified_prompt = f"Analyze these properties. Select the top 5 meeting the client's needs, provide your reasoning and an overall summary. For each property, be sure to include its exact URL: {search}\n\nHere are all the properties:\n{json.dumps(zillow_details, indent=2)}"
             
-            agent_result = await real_estate_agent.run(modified_prompt)
-            
-            # Charge for token usage from real estate agent
-            agent_usage = agent_result.usage()
-            await Actor.charge(event_name='1k-llm-tokens', count=math.ceil(agent_usage.total_tokens / 1000))
+            # Ground value judgements in the market statistics of the listings' areas
+            market_stats_text = format_market_stats(market_stats)
+            if market_stats_text:
+                modified_prompt += f"\n\nMarket statistics for these areas from previous searches (p25 / median / p75):\n{market_stats_text}"
             
             # Create a dictionary mapping URLs to their full zillow_details
             url_to_details = {prop.get('url', ''): prop for prop in zillow_details}
             
+            if stream_results:
+                async with streaming_real_estate_agent.run_stream(modified_prompt) as agent_result:
+                    pushed = 0
+                    async for partial in agent_result.stream():
+                        # Every property except the last one in a partial result is complete
+                        complete = partial.get('properties', [])[:-1]
+                        for ai_prop in complete[pushed:]:
+                            try:
+                                streamed_prop = Property.model_validate(ai_prop)
+                            except ValidationError:
+                                # Defer this and later properties to the final validation by get_data()
+                                break
+                            streamed_recommendations.append(merge_recommendation(streamed_prop, url_to_details))
+                            await Actor.push_data(recommendation_item(streamed_recommendations[-1], zillow_details, compact_storage))
+                            pushed += 1
+                    
+                    agent_data = RealEstateAgentResult.model_validate(await agent_result.get_data())
+                    for ai_prop in agent_data.properties[pushed:]:
+                        streamed_recommendations.append(merge_recommendation(ai_prop, url_to_details))
+                        await Actor.push_data(recommendation_item(streamed_recommendations[-1], zillow_details, compact_storage))
+                    agent_usage = agent_result.usage()
+            else:
+                agent_result = await real_estate_agent.run(modified_prompt)
+                agent_data = agent_result.data
+                agent_usage = agent_result.usage()
+            
+            # Charge for token usage from real estate agent
+            await Actor.charge(event_name='1k-llm-tokens', count=math.ceil(agent_usage.total_tokens / 1000))
+            
             # Merge AI recommendations with full property details
-            enhanced_recommendations = []
-            for ai_prop in agent_result.data.properties:
-                # Get the URL from the AI's evaluation
-                ai_prop_data = ai_prop.model_dump()
-                url = ai_prop_data.get('url', '')
-                
-                # Find matching property in zillow_details by URL
-                full_property_details = url_to_details.get(url)
-                
-                if full_property_details:
-                    # Keep all the original Zillow details
-                    enhanced_property = dict(full_property_details)
-                    # Add the AI's reason
-                    enhanced_property['match_reason'] = ai_prop_data.get('match_reason', '')
-                    enhanced_recommendations.append(enhanced_property)
-                else:
-                    # If no match found, use the AI's data as fallback
-                    enhanced_recommendations.append(ai_prop_data)
+            enhanced_recommendations = [merge_recommendation(ai_prop, url_to_details) for ai_prop in agent_data.properties]
             
             # Add enhanced recommendations to output
             output_data['property_recommendations'] = enhanced_recommendations
-            output_data['summary'] = agent_result.data.summary
+            output_data['summary'] = agent_data.summary
             
             # Generate markdown report
             markdown_report = generate_markdown_report(
                 search=search,
                 search_parameters=output_data['search_parameters'],
                 recommendations=output_data['property_recommendations'],
-                summary=output_data['summary']
+                summary=output_data['summary'],
+                market_stats=market_stats
             )
             
             # Add markdown report to output data
             output_data['markdown_report'] = markdown_report
             
-            # Save markdown report to KV store as well
-            await default_kv_store.set_value('property_report.md', markdown_report)
+            # Save markdown report to KV store as well, in compact mode it is stored with the run output below
+            if not compact_storage:
+                await default_kv_store.set_value('property_report.md', markdown_report)
             
             # Log success
             Actor.log.info("Markdown report generated and saved successfully")
             
         except Exception as e:
             Actor.log.error(f"Error during property analysis: {str(e)}")
-            output_data['property_recommendations'] = []
-            output_data['summary'] = "Unable to analyze properties due to an error"
-            output_data['markdown_report'] = "# Error\n\nUnable to generate property report due to an error."
+            if streamed_recommendations:
+                # Match the recommendation items that were already pushed
+                output_data['property_recommendations'] = streamed_recommendations
+                output_data['summary'] = f"The property analysis failed after {len(streamed_recommendations)} recommendations were made, so the list is incomplete and has no summary"
+                output_data['markdown_report'] = f"# Error\n\nThe property analysis failed after {len(streamed_recommendations)} recommendations were made, so no full report could be generated."
+            else:
+                output_data['property_recommendations'] = []
+                output_data['summary'] = "Unable to analyze properties due to an error"
+                output_data['markdown_report'] = "# Error\n\nUnable to generate property report due to an error."
+        
+        if compact_storage:
+            # Store listings once and let the dataset item refer to them by id
+            run_output = encode_run_output(
+                search_parameters=search_parameters,
+                listings=zillow_details,
+                recommendations=output_data['property_recommendations'],
+                summary=output_data['summary'],
+                markdown_report=output_data['markdown_report']
+            )
+            await default_kv_store.set_value('run_output', run_output, content_type=CONTENT_TYPE)
+            Actor.log.info(f"Saved compact run output ({len(run_output)} bytes)")
+            
+            output_data['property_recommendations'] = recommendation_refs(zillow_details, output_data['property_recommendations'])
+            output_data['storage_key'] = 'run_output'
+            # The report is only stored inside the compact run output
+            del output_data['markdown_report']
         
         # Push the result to Apify
-        await Actor.push_data(output_data)
+        if stream_results:
+            # Search parameters, listings and recommendations have already been pushed
+            report_item = {'type': 'report', 'summary': output_data['summary'], 'market_stats': market_stats}
+            if compact_storage:
+                report_item['storage_key'] = output_data['storage_key']
+            else:
+                report_item['markdown_report'] = output_data['markdown_report']
+            await Actor.push_data(report_item)
+        else:
+            await Actor.push_data(output_data)
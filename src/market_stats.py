@@ -0,0 +1,334 @@
+import hashlib
+import math
+import time
+from typing import List, Dict, Any, Iterable, Optional
+
+from apify import Actor
+
+MARKET_STATS_STORE = "market-stats"
+MARKET_STATS_KEY = "index"
+
+# Bump whenever the stored index layout changes
+INDEX_VERSION = 1
+
+# Listings not seen by any search for this long are removed from the index
+STALE_AFTER_DAYS = 90
+
+# Quantiles reported per metric
+QUANTILES = {"p25": 0.25, "median": 0.5, "p75": 0.75}
+
+class QuantileSketch:
+    """Streaming quantile sketch with bounded relative error.
+
+    Values are counted in logarithmically sized buckets, so every reported
+    quantile is within relative_accuracy of a true value of the stream. The
+    number of buckets grows with the logarithm of the value range only, and
+    values can be removed again through the bucket key add() returned.
+    """
+
+    def __init__(
+        self,
+        relative_accuracy: float = 0.02,
+        buckets: Optional[Dict[int, int]] = None,
+        zero_count: int = 0
+    ):
+        self.relative_accuracy = relative_accuracy
+        self.buckets = buckets or {}
+        self.zero_count = zero_count
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.buckets.values())
+
+    def add(self, value: float) -> Optional[int]:
+        """Add a non-negative value to the sketch and return its bucket key, None for zero."""
+        if value == 0:
+            self.zero_count += 1
+            return None
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        return key
+
+    def remove(self, key: Optional[int]) -> None:
+        """Remove a value previously added to the bucket with the given key."""
+        if key is None:
+            self.zero_count = max(self.zero_count - 1, 0)
+            return
+        remaining = self.buckets.get(key, 0) - 1
+        if remaining > 0:
+            self.buckets[key] = remaining
+        else:
+            self.buckets.pop(key, None)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Get the estimated value at quantile q, or None if the sketch is empty."""
+        count = self.count
+        if count == 0:
+            return None
+        rank = q * (count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return 2 * self._gamma ** key / (self._gamma + 1)
+        return None
+
+    def copy(self) -> "QuantileSketch":
+        return QuantileSketch(self.relative_accuracy, dict(self.buckets), self.zero_count)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "a": self.relative_accuracy,
+            "z": self.zero_count,
+            # JSON object keys must be strings
+            "b": {str(key): count for key, count in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "QuantileSketch":
+        return cls(
+            relative_accuracy=data["a"],
+            buckets={int(key): count for key, count in data["b"].items()},
+            zero_count=data["z"],
+        )
+
+def _is_positive(value: Any) -> bool:
+    return isinstance(value, (int, float)) and value > 0
+
+def _item_metrics(item: Dict[str, Any], for_rent: bool) -> Dict[str, List[float]]:
+    """Get the market metric values a raw Zillow detail scraper item contributes.
+
+    Apartment buildings contribute one rent per bedroom value per floor plan,
+    so no value is an average over units or depends on the search filters.
+    """
+    metrics: Dict[str, List[float]] = {}
+    floor_plans = item.get("floorPlans") or []
+    if floor_plans:
+        if for_rent:
+            rents = []
+            for plan in floor_plans:
+                price = plan.get("minPrice") or plan.get("maxPrice")
+                beds = plan.get("beds")
+                if _is_positive(price) and _is_positive(beds):
+                    rents.append(price / beds)
+            if rents:
+                metrics["rent_per_bedroom"] = rents
+    else:
+        price = item.get("price")
+        if _is_positive(price):
+            living_area = item.get("livingArea")
+            bedrooms = item.get("bedrooms")
+            if not for_rent and _is_positive(living_area):
+                metrics["price_per_sqft"] = [price / living_area]
+            if for_rent and _is_positive(bedrooms):
+                metrics["rent_per_bedroom"] = [price / bedrooms]
+    days_on_market = item.get("daysOnZillow")
+    if isinstance(days_on_market, (int, float)) and days_on_market >= 0:
+        metrics["days_on_market"] = [days_on_market]
+    return metrics
+
+def _listing_id(url: str) -> str:
+    """Get a short stable id for a listing URL."""
+    return hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+
+def _segment_key(zipcode: str, property_type: Optional[str], for_rent: bool) -> str:
+    return f"{zipcode}|{property_type or 'UNKNOWN'}|{'rent' if for_rent else 'sale'}"
+
+def _today() -> int:
+    return int(time.time() // 86400)
+
+class MarketStatsSnapshot:
+    """Read-only copy of the sketches of a MarketStatsIndex, used to summarize it."""
+
+    def __init__(self, segments: Dict[str, Dict[str, QuantileSketch]], listing_counts: Dict[str, int]):
+        self.segments = segments
+        self.listing_counts = listing_counts
+
+    def summarize(self, listings: Iterable[Dict[str, Any]], for_rent: bool, limit: int = 10) -> List[Dict[str, Any]]:
+        """Summarize the segments the given listings belong to.
+
+        Args:
+            listings: Property objects whose market segments should be summarized
+            for_rent: Whether the properties are for rent (True) or for sale (False)
+            limit: Maximum number of segments, the ones with most listings first
+
+        Returns:
+            List of segment summaries with listing counts and quantiles per metric
+        """
+        segment_counts: Dict[str, int] = {}
+        for listing in listings:
+            if listing.get("zipcode"):
+                key = _segment_key(listing["zipcode"], listing.get("homeType"), for_rent)
+                segment_counts[key] = segment_counts.get(key, 0) + 1
+
+        summaries = []
+        for key in sorted(segment_counts, key=segment_counts.get, reverse=True)[:limit]:
+            segment = self.segments.get(key)
+            if not segment:
+                continue
+            metrics = {
+                metric: {
+                    "count": sketch.count,
+                    **{name: round(sketch.quantile(q), 2) for name, q in QUANTILES.items()},
+                }
+                for metric, sketch in segment.items()
+                if sketch.count > 0
+            }
+            if not metrics:
+                continue
+            zipcode, property_type, listing_type = key.split("|")
+            summaries.append({
+                "zipcode": zipcode,
+                "property_type": property_type,
+                "listing_type": listing_type,
+                "listings": self.listing_counts.get(key, 0),
+                "metrics": metrics,
+            })
+        return summaries
+
+class MarketStatsIndex:
+    """Market statistics per ZIP code, property type and listing type.
+
+    Each segment holds a QuantileSketch per metric and a record of the
+    listings in it, keyed by a hash of their URL, with the day they were last
+    seen and the sketch buckets their values went into. A listing seen again
+    replaces its earlier values, so repeated searches do not count it twice
+    and its days on market stay current. Listings no search has returned for
+    STALE_AFTER_DAYS are removed by prune(), on the assumption that they are
+    off the market.
+
+    The sketches stay small, but the listing records grow with the number of
+    listings seen in the last STALE_AFTER_DAYS, at roughly 100 bytes of JSON
+    each, and the whole index is loaded and saved on every run.
+    """
+
+    def __init__(
+        self,
+        segments: Optional[Dict[str, Dict[str, QuantileSketch]]] = None,
+        listings: Optional[Dict[str, Dict[str, list]]] = None
+    ):
+        self.segments = segments or {}
+        self.listings = listings or {}
+
+    def _remove_entry(self, key: str, entry: list) -> None:
+        segment = self.segments.get(key, {})
+        for metric, bucket_keys in entry[1].items():
+            sketch = segment.get(metric)
+            if sketch is not None:
+                for bucket_key in bucket_keys:
+                    sketch.remove(bucket_key)
+
+    def add_items(self, items: Iterable[Dict[str, Any]], for_rent: bool) -> None:
+        """Add raw Zillow detail scraper items to the index, replacing earlier values of known listings."""
+        today = _today()
+        for item in items:
+            zipcode = item.get("zipcode") or (item.get("address") or {}).get("zipcode")
+            url = item.get("addressOrUrlFromInput") or item.get("url")
+            if not zipcode or not url:
+                continue
+            key = _segment_key(zipcode, item.get("homeType"), for_rent)
+            segment = self.segments.setdefault(key, {})
+            seen = self.listings.setdefault(key, {})
+            listing_id = _listing_id(url)
+
+            previous = seen.pop(listing_id, None)
+            if previous is not None:
+                self._remove_entry(key, previous)
+
+            bucket_keys = {
+                metric: [segment.setdefault(metric, QuantileSketch()).add(value) for value in values]
+                for metric, values in _item_metrics(item, for_rent).items()
+            }
+            seen[listing_id] = [today, bucket_keys]
+
+    def prune(self) -> int:
+        """Remove listings not seen for STALE_AFTER_DAYS and return how many were removed."""
+        cutoff = _today() - STALE_AFTER_DAYS
+        removed = 0
+        for key in list(self.listings):
+            seen = self.listings[key]
+            for listing_id in [listing_id for listing_id, entry in seen.items() if entry[0] < cutoff]:
+                self._remove_entry(key, seen.pop(listing_id))
+                removed += 1
+            if not seen:
+                del self.listings[key]
+                self.segments.pop(key, None)
+        return removed
+
+    def snapshot(self) -> "MarketStatsSnapshot":
+        """Copy the sketches and listing counts, leaving out the listing records."""
+        return MarketStatsSnapshot(
+            segments={
+                key: {metric: sketch.copy() for metric, sketch in segment.items()}
+                for key, segment in self.segments.items()
+            },
+            listing_counts={key: len(seen) for key, seen in self.listings.items()},
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": INDEX_VERSION,
+            "segments": {
+                key: {metric: sketch.to_dict() for metric, sketch in segment.items()}
+                for key, segment in self.segments.items()
+            },
+            "listings": self.listings,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "MarketStatsIndex":
+        return cls(
+            segments={
+                key: {metric: QuantileSketch.from_dict(sketch) for metric, sketch in segment.items()}
+                for key, segment in data["segments"].items()
+            },
+            listings={
+                key: {listing_id: list(entry) for listing_id, entry in seen.items()}
+                for key, seen in data["listings"].items()
+            },
+        )
+
+async def load_market_stats() -> MarketStatsIndex:
+    """Load the market statistics index shared across runs from its named KV store."""
+    store = await Actor.open_key_value_store(name=MARKET_STATS_STORE)
+    data = await store.get_value(MARKET_STATS_KEY)
+    if not data:
+        return MarketStatsIndex()
+    if data.get("version") != INDEX_VERSION:
+        raise ValueError(f"Unsupported market statistics index version: {data.get('version')}")
+    return MarketStatsIndex.from_dict(data)
+
+async def save_market_stats(index: MarketStatsIndex) -> None:
+    """Prune stale listings and save the market statistics index to its named KV store.
+
+    The store has no concurrency control: when runs overlap, the last one to
+    save overwrites the updates of the others.
+    """
+    removed = index.prune()
+    if removed:
+        Actor.log.info(f"Removed {removed} stale listings from the market statistics index")
+    store = await Actor.open_key_value_store(name=MARKET_STATS_STORE)
+    await store.set_value(MARKET_STATS_KEY, index.to_dict())
+
+def format_market_stats(summaries: List[Dict[str, Any]]) -> str:
+    """Format segment summaries as compact text lines for the real estate agent prompt."""
+    metric_labels = {
+        "price_per_sqft": "price/sqft",
+        "rent_per_bedroom": "rent/bedroom",
+        "days_on_market": "days on market",
+    }
+    lines = []
+    for summary in summaries:
+        parts = [
+            f"{metric_labels.get(metric, metric)} p25 {stats['p25']:,.0f} / median {stats['median']:,.0f} / p75 {stats['p75']:,.0f}"
+            for metric, stats in summary["metrics"].items()
+        ]
+        lines.append(
+            f"- ZIP {summary['zipcode']}, {summary['property_type']}, {summary['listing_type']} "
+            f"({summary['listings']} listings): " + "; ".join(parts)
+        )
+    return "\n".join(lines)
@@ -1,9 +1,37 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, TypedDict
 from pydantic import BaseModel, Field
 
 class Deps:
     pass
 
+# Fields of the property objects built by tools.filter_zillow_detail, in storage
+# order. Keep in sync when that function adds or removes fields; the compact
+# storage format stores these as columns and any other keys as extras.
+LISTING_FIELDS = (
+    "city",
+    "state",
+    "streetAddress",
+    "zipcode",
+    "country",
+    "yearBuilt",
+    "homeType",
+    "livingArea",
+    "daysOnZillow",
+    "description",
+    "url",
+    "bedrooms",
+    "bathrooms",
+    "price",
+    "features",
+    "facts",
+    "amenities",
+    "communityAmenities",
+    "appliances",
+    "bikescore",
+    "transitScore",
+    "walkScore",
+)
+
 class ZillowSearchParameters(BaseModel):
     # Essential search parameters
     search_term: str = Field(..., description="Location to search (e.g. city, zip code)")
@@ -44,3 +72,12 @@ class RealEstateAgentResult(BaseModel):
     properties: List[Property]
     summary: str
 
+# Partial validation only supports TypedDicts, so the streamed agent result mirrors
+# RealEstateAgentResult with every key optional
+class StreamedProperty(TypedDict, total=False):
+    match_reason: str
+    url: str
+
+class StreamedRealEstateAgentResult(TypedDict, total=False):
+    properties: List[StreamedProperty]
+    summary: str
@@ -50,7 +50,7 @@ Your job is to:
 
 When analyzing properties, consider:
 - How well each property matches the search parameters
-- Price relative to features and location
+- Price relative to features and location, compared against the market statistics for the area when provided
 - Special amenities or unique selling points
 - Potential drawbacks or considerations
 
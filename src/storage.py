@@ -0,0 +1,175 @@
+import zlib
+from functools import cached_property
+from typing import List, Dict, Any, Iterator, Optional
+
+import msgpack
+
+from .models import LISTING_FIELDS
+
+# Bump whenever the container layout changes. Records list their own fields,
+# so adding to LISTING_FIELDS keeps older records readable.
+FORMAT_VERSION = 1
+
+CONTENT_TYPE = "application/x-msgpack"
+
+def _pack(value: Any) -> bytes:
+    """Serialize a value with msgpack and compress it."""
+    return zlib.compress(msgpack.packb(value, use_bin_type=True), level=9)
+
+def _unpack(blob: bytes) -> Any:
+    """Decompress and deserialize a value written by _pack."""
+    return msgpack.unpackb(zlib.decompress(blob), raw=False)
+
+def recommendation_refs(listings: List[Dict[str, Any]], recommendations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Replace full property details in recommendations with references to the listings.
+
+    Args:
+        listings: Property objects as returned by get_zillow_details
+        recommendations: Recommendations merged with their property details
+
+    Returns:
+        List of recommendations holding only the listing_id, url and match_reason.
+        listing_id is the index of the property in listings, or None if the
+        recommended URL was not among the listings.
+    """
+    url_to_id = {listing.get('url', ''): i for i, listing in enumerate(listings)}
+    return [
+        {
+            'listing_id': url_to_id.get(rec.get('url', '')),
+            'url': rec.get('url', ''),
+            'match_reason': rec.get('match_reason', ''),
+        }
+        for rec in recommendations
+    ]
+
+def encode_run_output(
+    search_parameters: dict,
+    listings: List[Dict[str, Any]],
+    recommendations: List[Dict[str, Any]],
+    summary: str,
+    markdown_report: str
+) -> bytes:
+    """Encode the artifacts of a run into the compact storage format.
+
+    Listings are stored column by column, each column compressed separately so
+    readers only decode the fields they access. Recommendations refer to the
+    listings by id instead of repeating their details.
+
+    Args:
+        search_parameters: Parsed search parameters including the Zillow URL
+        listings: Property objects as returned by get_zillow_details
+        recommendations: Recommendations merged with their property details
+        summary: Summary written by the real estate agent
+        markdown_report: Report generated by generate_markdown_report
+
+    Returns:
+        Encoded run output, readable with CompactRunOutput
+    """
+    # Listings without a field are recorded as absent, so they decode without that key
+    # rather than with a None value
+    columns = {
+        field: _pack({
+            "values": [listing.get(field) for listing in listings],
+            "absent": [i for i, listing in enumerate(listings) if field not in listing],
+        })
+        for field in LISTING_FIELDS
+    }
+    extra = [
+        {key: value for key, value in listing.items() if key not in LISTING_FIELDS} or None
+        for listing in listings
+    ]
+
+    container = {
+        "version": FORMAT_VERSION,
+        "fields": list(LISTING_FIELDS),
+        "count": len(listings),
+        "columns": columns,
+        "extra": _pack(extra),
+        "recommendations": recommendation_refs(listings, recommendations),
+        "search_parameters": search_parameters,
+        "summary": summary,
+        "markdown_report": _pack(markdown_report),
+    }
+    return msgpack.packb(container, use_bin_type=True)
+
+class CompactRunOutput:
+    """Lazy reader for run output encoded with encode_run_output.
+
+    Only the container is decoded on construction; listing columns and the
+    markdown report are decompressed on first access.
+    """
+
+    def __init__(self, data: bytes):
+        self._container = msgpack.unpackb(data, raw=False)
+        version = self._container.get("version")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact storage format version: {version}")
+        self._fields = self._container["fields"]
+        self._columns: Dict[str, list] = {}
+        self._absent: Dict[str, set] = {}
+
+    def __len__(self) -> int:
+        return self._container["count"]
+
+    @property
+    def search_parameters(self) -> dict:
+        return self._container["search_parameters"]
+
+    @property
+    def summary(self) -> str:
+        return self._container["summary"]
+
+    @cached_property
+    def markdown_report(self) -> str:
+        return _unpack(self._container["markdown_report"])
+
+    @cached_property
+    def _extra(self) -> list:
+        return _unpack(self._container["extra"])
+
+    def _load_column(self, field: str) -> None:
+        if field not in self._fields:
+            raise KeyError(field)
+        column = _unpack(self._container["columns"][field])
+        self._columns[field] = column["values"]
+        self._absent[field] = set(column["absent"])
+
+    def column(self, field: str) -> list:
+        """Get the values of one listing field for all listings, None where a listing lacks it."""
+        if field not in self._columns:
+            self._load_column(field)
+        return self._columns[field]
+
+    def has_field(self, listing_id: int, field: str) -> bool:
+        """Check whether a listing had a field when it was stored, even if its value is None."""
+        if field not in self._columns:
+            self._load_column(field)
+        return listing_id not in self._absent[field]
+
+    def listing(self, listing_id: int) -> Dict[str, Any]:
+        """Get the full property object of a single listing."""
+        if not 0 <= listing_id < len(self):
+            raise IndexError(listing_id)
+        listing = {
+            field: self.column(field)[listing_id]
+            for field in self._fields
+            if self.has_field(listing_id, field)
+        }
+        listing.update(self._extra[listing_id] or {})
+        return listing
+
+    def listings(self) -> Iterator[Dict[str, Any]]:
+        """Iterate over the full property objects of all listings."""
+        for listing_id in range(len(self)):
+            yield self.listing(listing_id)
+
+    def recommendations(self, with_details: bool = True) -> Iterator[Dict[str, Any]]:
+        """Iterate over the recommendations, optionally merged with their property details."""
+        for ref in self._container["recommendations"]:
+            listing_id: Optional[int] = ref.get("listing_id")
+            if not with_details or listing_id is None:
+                yield dict(ref)
+                continue
+            recommendation = self.listing(listing_id)
+            recommendation["match_reason"] = ref.get("match_reason", "")
+            yield recommendation
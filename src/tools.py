@@ -1,5 +1,5 @@
 from apify import Actor
-from typing import List, Tuple
+from typing import AsyncIterator, List, Optional, Tuple
 from apify_client import ApifyClient
 import os
 import json
@@ -9,6 +9,8 @@ from typing import Dict, Any
 from dotenv import load_dotenv
 
 from .models import ZillowSearchParameters
+from .floor_plans import apply_unit_level_matching
+from .market_stats import MarketStatsIndex
 
 load_dotenv()
 
@@ -195,34 +197,158 @@ async def search_zillow(search_url: str) -> List[Dict[str, Any]]:
         Actor.log.error(f"Error during Zillow search: {str(e)}")
         return []
 
-async def get_zillow_details(property_urls: List[str], for_rent: bool) -> List[Dict[str, Any]]:
-    """Get detailed information about specific Zillow property listings.
+def safe_get(obj, *keys, default=None):
+    """Safely access nested dictionary properties."""
+    current = obj
+    for key in keys:
+        if not isinstance(current, dict):
+            return default
+        current = current.get(key)
+        if current is None:
+            return default
+    return current
+
+def filter_zillow_detail(item: Dict[str, Any], average_floor_plans: bool = True) -> Dict[str, Any]:
+    """Reduce a raw Zillow detail scraper item to the fields used downstream.
     
     Args:
-        property_urls: List of Zillow property detail URLs
-        for_rent: Whether the properties are for rent (True) or for sale (False)
-
+        item: Raw item from the Zillow detail scraper dataset
+        average_floor_plans: Whether to describe apartment buildings by the average of
+            their floor plans, otherwise the building's own values are kept
+        
     Returns:
-        List of property objects with detailed information
+        Property object with the relevant fields only, as listed in models.LISTING_FIELDS
     """
-    if not property_urls:
-        Actor.log.warning("No property URLs provided to get_zillow_details")
-        return []
-        
-    Actor.log.info(f"Fetching details for {len(property_urls)} Zillow properties")
+    # Basic properties with simple fallbacks
+    filtered_item = {
+        "city": item.get("city") or safe_get(item, "address", "city"),
+        "state": item.get("state") or safe_get(item, "address", "state"),
+        "streetAddress": item.get("streetAddress") or safe_get(item, "address", "streetAddress"),
+        "zipcode": item.get("zipcode") or safe_get(item, "address", "zipcode"),
+        "country": item.get("country"),
+        "yearBuilt": item.get("yearBuilt"),
+        "homeType": item.get("homeType"),
+        "livingArea": item.get("livingArea"),
+        "daysOnZillow": item.get("daysOnZillow"),
+        "description": item.get("description"),
+        "url": item.get("addressOrUrlFromInput") or item.get("url")
+    }
     
+    # Process floor plans for apartments to get average beds, baths, and price
+    floor_plans = safe_get(item, "floorPlans")
+    if average_floor_plans and floor_plans and len(floor_plans) > 0:
+        total_beds = 0
+        total_baths = 0
+        total_price = 0
+        count = 0
+        
+        for plan in floor_plans:
+            if plan.get("beds") is not None and plan.get("baths") is not None:
+                count += 1
+                total_beds += plan.get("beds", 0)
+                total_baths += plan.get("baths", 0)
+                # Use minPrice or maxPrice, whichever is available
+                price = plan.get("minPrice") or plan.get("maxPrice", 0)
+                total_price += price
+        
+        if count > 0:
+            filtered_item["bedrooms"] = int(total_beds / count)
+            filtered_item["bathrooms"] = int(total_baths / count)
+            filtered_item["price"] = int(total_price / count)
+        else:
+            filtered_item["bedrooms"] = item.get("bedrooms")
+            filtered_item["bathrooms"] = item.get("bathrooms")
+            filtered_item["price"] = item.get("price")
+    else:
+        filtered_item["bedrooms"] = item.get("bedrooms")
+        filtered_item["bathrooms"] = item.get("bathrooms")
+        filtered_item["price"] = item.get("price")
+    
+    # Complex nested properties
+    homeinsights = safe_get(item, "homeinsights")
+    if homeinsights:
+        insights = safe_get(homeinsights, "insights")
+        if insights and len(insights) > 0:
+            filtered_item["features"] = safe_get(insights[0], "phrases")
+    
+    # Safe access to other nested properties
+    filtered_item["facts"] = safe_get(item, "resoFacts", "atAGlanceFacts")
+    filtered_item["amenities"] = safe_get(item, "amenityDetails", "customAmenities", "rawAmenities")
+    filtered_item["communityAmenities"] = safe_get(item, "commonUnitAmenities")
+    
+    # Complex conditional property - add null checks before concatenating
+    building_appliances = safe_get(item, "buildingAttributes", "appliances") or []
+    reso_appliances = safe_get(item, "resoFacts", "appliances") or []
+    filtered_item["appliances"] = list(set(building_appliances + reso_appliances))
+    
+    # Scores
+    filtered_item["bikescore"] = safe_get(item, "bikescore", "bikescore")
+    filtered_item["transitScore"] = safe_get(item, "transitScore", "transit_score")
+    filtered_item["walkScore"] = safe_get(item, "walkScore", "walk_score")
+    
+    return filtered_item
+
+def _zillow_details_run_input(property_urls: List[str], for_rent: bool) -> Dict[str, Any]:
+    """Build the Zillow detail scraper input for the given property URLs."""
     # Prepare the start URLs in the format required by the actor
     start_urls = [{"url": url, "method": "GET"} for url in property_urls]
     
     property_status = "FOR_RENT" if for_rent else "FOR_SALE"
     
-    run_input = {
+    return {
         "extractBuildingUnits": "disabled",
         "propertyStatus": property_status,
         "startUrls": start_urls,
         "addresses": [],
         "searchResultsDatasetId": ""
     }
+
+async def _process_detail_items(
+    items: List[Dict[str, Any]],
+    for_rent: bool,
+    unit_search_params: Optional[ZillowSearchParameters],
+    market_stats_index: Optional[MarketStatsIndex]
+) -> List[Dict[str, Any]]:
+    """Turn raw Zillow detail scraper items into property objects and charge for them."""
+    if market_stats_index is not None:
+        market_stats_index.add_items(items, for_rent=for_rent)
+    
+    # Filter to include only the specified fields
+    # Unit-level matching describes apartment buildings itself, so skip the averaging
+    filtered_results = [filter_zillow_detail(item, average_floor_plans=unit_search_params is None) for item in items]
+    if unit_search_params is not None:
+        filtered_results = apply_unit_level_matching(items, filtered_results, unit_search_params)
+    
+    Actor.log.info(f"Processed {len(filtered_results)} detailed property listings")
+    
+    await Actor.charge('tool-result', len(filtered_results))
+    return filtered_results
+
+async def get_zillow_details(
+    property_urls: List[str],
+    for_rent: bool,
+    unit_search_params: Optional[ZillowSearchParameters] = None,
+    market_stats_index: Optional[MarketStatsIndex] = None
+) -> List[Dict[str, Any]]:
+    """Get detailed information about specific Zillow property listings.
+    
+    Args:
+        property_urls: List of Zillow property detail URLs
+        for_rent: Whether the properties are for rent (True) or for sale (False)
+        unit_search_params: If given, apartment buildings are matched against these
+            search parameters per floor plan instead of averaging their floor plans
+        market_stats_index: If given, the raw listings are added to this market statistics index
+
+    Returns:
+        List of property objects with detailed information
+    """
+    if not property_urls:
+        Actor.log.warning("No property URLs provided to get_zillow_details")
+        return []
+        
+    Actor.log.info(f"Fetching details for {len(property_urls)} Zillow properties")
+    
+    run_input = _zillow_details_run_input(property_urls, for_rent)
     
     try:
         # Execute the actor and get the run info
@@ -238,101 +364,89 @@ async def get_zillow_details(property_urls: List[str], for_rent: bool) -> List[D
         if not all_items:
             Actor.log.warning("No items found in the Zillow detail scraper dataset")
             return []
-            
-        # Safe getter function for nested properties
-        def safe_get(obj, *keys, default=None):
-            """Safely access nested dictionary properties."""
-            current = obj
-            for key in keys:
-                if not isinstance(current, dict):
-                    return default
-                current = current.get(key)
-                if current is None:
-                    return default
-            return current
         
-        # Filter to include only the specified fields
-        filtered_results = []
-        for item in all_items:
-            # Basic properties with simple fallbacks
-            filtered_item = {
-                "city": item.get("city") or safe_get(item, "address", "city"),
-                "state": item.get("state") or safe_get(item, "address", "state"),
-                "streetAddress": item.get("streetAddress") or safe_get(item, "address", "streetAddress"),
-                "zipcode": item.get("zipcode") or safe_get(item, "address", "zipcode"),
-                "country": item.get("country"),
-                "yearBuilt": item.get("yearBuilt"),
-                "description": item.get("description"),
-                "url": item.get("addressOrUrlFromInput") or item.get("url")
-            }
-            
-            # Process floor plans for apartments to get average beds, baths, and price
-            floor_plans = safe_get(item, "floorPlans")
-            if floor_plans and len(floor_plans) > 0:
-                total_beds = 0
-                total_baths = 0
-                total_price = 0
-                count = 0
-                
-                for plan in floor_plans:
-                    if plan.get("beds") is not None and plan.get("baths") is not None:
-                        count += 1
-                        total_beds += plan.get("beds", 0)
-                        total_baths += plan.get("baths", 0)
-                        # Use minPrice or maxPrice, whichever is available
-                        price = plan.get("minPrice") or plan.get("maxPrice", 0)
-                        total_price += price
-                
-                if count > 0:
-                    filtered_item["bedrooms"] = int(total_beds / count)
-                    filtered_item["bathrooms"] = int(total_baths / count)
-                    filtered_item["price"] = int(total_price / count)
-                else:
-                    filtered_item["bedrooms"] = item.get("bedrooms")
-                    filtered_item["bathrooms"] = item.get("bathrooms")
-                    filtered_item["price"] = item.get("price")
-            else:
-                filtered_item["bedrooms"] = item.get("bedrooms")
-                filtered_item["bathrooms"] = item.get("bathrooms")
-                filtered_item["price"] = item.get("price")
-            
-            # Complex nested properties
-            homeinsights = safe_get(item, "homeinsights")
-            if homeinsights:
-                insights = safe_get(homeinsights, "insights")
-                if insights and len(insights) > 0:
-                    filtered_item["features"] = safe_get(insights[0], "phrases")
-            
-            # Safe access to other nested properties
-            filtered_item["facts"] = safe_get(item, "resoFacts", "atAGlanceFacts")
-            filtered_item["amenities"] = safe_get(item, "amenityDetails", "customAmenities", "rawAmenities")
-            filtered_item["communityAmenities"] = safe_get(item, "commonUnitAmenities")
-            
-            # Complex conditional property - add null checks before concatenating
-            building_appliances = safe_get(item, "buildingAttributes", "appliances") or []
-            reso_appliances = safe_get(item, "resoFacts", "appliances") or []
-            filtered_item["appliances"] = list(set(building_appliances + reso_appliances))
+        return await _process_detail_items(all_items, for_rent, unit_search_params, market_stats_index)
+    except Exception as e:
+        Actor.log.error(f"Error during Zillow detail retrieval: {str(e)}")
+        return []
+
+async def stream_zillow_details(
+    property_urls: List[str],
+    for_rent: bool,
+    unit_search_params: Optional[ZillowSearchParameters] = None,
+    market_stats_index: Optional[MarketStatsIndex] = None,
+    poll_interval_secs: int = 5
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Get detailed information about Zillow listings batch by batch as the scraper produces them.
+    
+    Unlike get_zillow_details, the detail scraper is started without waiting for it
+    to finish and its dataset is polled, so callers can act on the first listings
+    while the remaining ones are still being scraped.
+    
+    Args:
+        property_urls: List of Zillow property detail URLs
+        for_rent: Whether the properties are for rent (True) or for sale (False)
+        unit_search_params: If given, apartment buildings are matched against these
+            search parameters per floor plan instead of averaging their floor plans
+        market_stats_index: If given, the raw listings are added to this market statistics index
+        poll_interval_secs: How long to wait for the run to finish between dataset polls
+
+    Yields:
+        Batches of property objects with detailed information
+    """
+    if not property_urls:
+        Actor.log.warning("No property URLs provided to stream_zillow_details")
+        return
+        
+    Actor.log.info(f"Streaming details for {len(property_urls)} Zillow properties")
+    
+    run_input = _zillow_details_run_input(property_urls, for_rent)
+    run_id = None
+    offset = 0
+    
+    try:
+        # Start the actor without waiting for it to finish
+        run = client.actor("maxcopell/zillow-detail-scraper").start(run_input=run_input, memory_mbytes=1024)
+        
+        if not run or not run.get("defaultDatasetId"):
+            Actor.log.error("Failed to get valid response from Zillow detail scraper actor")
+            return
+        
+        run_id = run["id"]
+        run_client = client.run(run_id)
+        dataset_client = client.dataset(run["defaultDatasetId"])
+        
+        while True:
+            run = run_client.wait_for_finish(wait_secs=poll_interval_secs)
+            # Transitional statuses like TIMING-OUT and ABORTING can still add items
+            finished = not run or run.get("status") in ("SUCCEEDED", "FAILED", "TIMED-OUT", "ABORTED")
             
-            # Scores
-            filtered_item["bikescore"] = safe_get(item, "bikescore", "bikescore")
-            filtered_item["transitScore"] = safe_get(item, "transitScore", "transit_score")
-            filtered_item["walkScore"] = safe_get(item, "walkScore", "walk_score")
+            # Only fetch the items added since the last poll
+            new_items = dataset_client.list_items(offset=offset).items
+            if new_items:
+                offset += len(new_items)
+                yield await _process_detail_items(new_items, for_rent, unit_search_params, market_stats_index)
             
-            filtered_results.append(filtered_item)
+            if finished:
+                break
         
-        Actor.log.info(f"Processed {len(filtered_results)} detailed property listings")
-        
-        await Actor.charge('tool-result', len(filtered_results))
-        return filtered_results
+        if offset == 0:
+            Actor.log.warning("No items found in the Zillow detail scraper dataset")
     except Exception as e:
-        Actor.log.error(f"Error during Zillow detail retrieval: {str(e)}")
-        return []
+        Actor.log.error(f"Error during Zillow detail streaming, continuing with a partial set of {offset} listings: {str(e)}")
+        if run_id:
+            # Stop the scraper so it is not billed for listings nobody will read
+            try:
+                client.run(run_id).abort()
+            except Exception as abort_error:
+                Actor.log.error(f"Error aborting Zillow detail scraper run {run_id}: {str(abort_error)}")
 
 def generate_markdown_report(
     search: str,
     search_parameters: dict, 
     recommendations: list,
-    summary: str
+    summary: str,
+    market_stats: Optional[list] = None
 ) -> str:
     """Generate a nicely formatted markdown report from the collected data"""
     
@@ -472,7 +586,30 @@ def generate_markdown_report(
 ---
 """
     
+    # Add market statistics for the areas of the listings
+    market_stats_section = ""
+    metric_labels = {
+        "price_per_sqft": "Price per sqft",
+        "rent_per_bedroom": "Rent per bedroom",
+        "days_on_market": "Days on market",
+    }
+    market_rows = []
+    for segment in market_stats or []:
+        for metric, stats in segment.get('metrics', {}).items():
+            unit = "" if metric == "days_on_market" else "$"
+            market_rows.append(
+                f"| {segment['zipcode']} | {segment['property_type'].replace('_', ' ').title()} | {metric_labels.get(metric, metric)} "
+                f"| {unit}{stats['p25']:,.0f} | {unit}{stats['median']:,.0f} | {unit}{stats['p75']:,.0f} | {segment['listings']} |"
+            )
+    if market_rows:
+        market_stats_section = """
+## Market Statistics
+
+| ZIP Code | Property Type | Metric | 25th Percentile | Median | 75th Percentile | Listings |
+|---|---|---|---|---|---|---|
+""" + "\n".join(market_rows) + "\n"
+    
     # Combine all sections
-    markdown_report = f"{title}\n{summary_section}\n{listings_section}"
+    markdown_report = f"{title}\n{summary_section}\n{listings_section}{market_stats_section}"
     
     return markdown_report 
\ No newline at end of file